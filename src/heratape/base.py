@@ -2,7 +2,9 @@
 # Licensed under the 2-clause BSD License
 """Define the database base objects."""
 
+import functools
 import json
+import logging
 import os
 from abc import ABCMeta
 from datetime import date, datetime
@@ -12,90 +14,159 @@ from sqlalchemy import create_engine
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import Session, declarative_base
 from sqlalchemy.orm.session import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+try:
+    # faster json parsing if available
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+logger = logging.getLogger(__name__)
 
 config_file = os.path.expanduser("~/.heratape/heratape_config.json")
 
+# default connection pool settings, can be overridden with a "pool" section
+# for each database in the config file.
+DEFAULT_POOL_SETTINGS = {
+    "pool_size": 10,
+    "max_overflow": 20,
+    "pool_timeout": 30,
+    "pool_recycle": 1800,
+}
+
+# maximum number of rows sqlalchemy will put in a single multi-row INSERT when
+# doing bulk inserts (the sqlalchemy default is 1000). sqlalchemy also limits
+# the number of bound parameters per statement, so this is safe for wide tables.
+INSERTMANYVALUES_PAGE_SIZE = 10_000
+
+# value types that are compared exactly in `Base.isclose`, with a description
+# for the log message. Values are looked up by walking their type's MRO, so
+# subclasses are handled and bool is found before int.
+_EXACT_COMPARE_TYPES = {
+    bool: "a boolean",
+    int: "an int",
+    str: "a str",
+    datetime: "a datetime",
+    date: "a date",
+}
+
+# tolerances used by `Base.isclose` for columns that are not in the object's
+# `tols` attribute (the numpy defaults).
+_DEFAULT_TOLS = {"atol": 1e-08, "rtol": 1e-05}
+
+
+@functools.lru_cache(maxsize=8)
+def _make_engine(db_url, pool_size, max_overflow, pool_timeout, pool_recycle):
+    """
+    Make an engine for a database url, reusing it for repeated calls.
+
+    Caching the engines means that all the DB objects for a given url and
+    set of pool settings share a single connection pool.
+    """
+    if db_url.startswith("sqlite"):
+        # sqlite connections cannot be pooled in the usual way, use a single
+        # shared connection instead.
+        return create_engine(
+            db_url,
+            poolclass=StaticPool,
+            insertmanyvalues_page_size=INSERTMANYVALUES_PAGE_SIZE,
+        )
+    return create_engine(
+        db_url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_recycle=pool_recycle,
+        pool_pre_ping=True,
+        insertmanyvalues_page_size=INSERTMANYVALUES_PAGE_SIZE,
+    )
+
 
 class Base:
     """Base table object."""
 
+    @classmethod
+    def _get_column_names(cls):
+        """
+        Get a tuple of the column names for this table.
+
+        This is computed on the first call and then cached on the class. It
+        can't be done when the class is created because the table is only
+        added by the declarative machinery after that.
+        """
+        column_names = cls.__dict__.get("_column_names")
+        if column_names is None:
+            column_names = tuple(cls.__table__.columns.keys())
+            cls._column_names = column_names
+        return column_names
+
     def __repr__(self):
         """Define standard representation."""
-        columns = self.__table__.columns.keys()
-        rep_str = "<" + self.__class__.__name__ + "("
-        for c in columns:
-            rep_str += str(getattr(self, c)) + ", "
-        rep_str = rep_str[0:-2]
-        rep_str += ")>"
-        return rep_str
+        values = ", ".join(str(getattr(self, c)) for c in self._get_column_names())
+        return f"<{self.__class__.__name__}({values})>"
 
     def isclose(self, other):
         """Test if two objects are nearly equal."""
         if not isinstance(other, self.__class__):
-            print("not the same class")
+            logger.debug("not the same class")
             return False
 
-        self_columns = self.__table__.columns
-        other_columns = other.__table__.columns
+        column_names = self._get_column_names()
         # the following is structured as an assert because I cannot make it fail but
         # think it should be checked.
-        assert {col.name for col in self_columns} == {
-            col.name for col in other_columns
-        }, (
+        assert set(column_names) == set(other._get_column_names()), (
             "Set of columns are not the same. This should not happen, please make an "
             "issue in our repo."
         )
-        for col in self_columns:
-            self_col = getattr(self, col.name)
-            other_col = getattr(other, col.name)
+        # objects can define tolerances for some columns with a `tols` attribute
+        tols = getattr(self, "tols", None) or {}
+        for col in column_names:
+            self_col = getattr(self, col)
+            other_col = getattr(other, col)
             if not isinstance(other_col, type(self_col)):
-                print(
+                logger.debug(
                     f"column {col} has different types, left is {type(self_col)}, "
                     f"right is {type(other_col)}."
                 )
                 return False
-            if isinstance(self_col, bool):
-                # have to check bool before int because bool is a subclass of int
-                if self_col != other_col:
-                    print(f"column {col} is a boolean, values are not equal")
-                    return False
-            elif isinstance(self_col, int):
-                if self_col != other_col:
-                    print(f"column {col} is an int, values are not equal")
-                    return False
-            elif isinstance(self_col, str):
-                if self_col != other_col:
-                    print(f"column {col} is a str, values are not equal")
-                    return False
-            elif isinstance(self_col, datetime):
+            if self_col is None:
+                # nullable columns, both null (otherwise caught as different types)
+                continue
+            type_desc = None
+            for cls in type(self_col).__mro__:
+                type_desc = _EXACT_COMPARE_TYPES.get(cls)
+                if type_desc is not None:
+                    break
+            if type_desc is not None:
                 if self_col != other_col:
-                    print(f"column {col} is a datetime, values are not equal")
+                    logger.debug(f"column {col} is {type_desc}, values are not equal")
                     return False
-            elif isinstance(self_col, date):
-                if self_col != other_col:
-                    print(f"column {col} is a date, values are not equal")
+                continue
+
+            if (
+                isinstance(self_col, np.ndarray)
+                and self_col.shape == other_col.shape
+                and self_col.dtype == other_col.dtype
+                and np.array_equal(self_col, other_col)
+            ):
+                # exactly equal arrays (the common case) are close for any
+                # tolerance, so skip the tolerance checks.
+                continue
+
+            col_tols = tols.get(col, _DEFAULT_TOLS)
+            atol = col_tols["atol"]
+            rtol = col_tols["rtol"]
+            if isinstance(self_col, np.ndarray | list):
+                if not np.allclose(self_col, other_col, atol=atol, rtol=rtol):
+                    logger.debug(
+                        f"column {col} is a float-like array, values are not equal"
+                    )
                     return False
-            elif self_col is None:
-                # nullable columns, both null (otherwise caught as different types)
-                pass
             else:
-                if hasattr(self, "tols") and col.name in self.tols:
-                    atol = self.tols[col.name]["atol"]
-                    rtol = self.tols[col.name]["rtol"]
-                else:
-                    # use numpy defaults
-                    atol = 1e-08
-                    rtol = 1e-05
-                if isinstance(self_col, np.ndarray | list):
-                    if not np.allclose(self_col, other_col, atol=atol, rtol=rtol):
-                        print(
-                            f"column {col} is a float-like array, values are not equal"
-                        )
-                        return False
-                else:
-                    if not np.isclose(self_col, other_col, atol=atol, rtol=rtol):
-                        print(f"column {col} is float-like, values are not equal")
-                        return False
+                if not np.isclose(self_col, other_col, atol=atol, rtol=rtol):
+                    logger.debug(f"column {col} is float-like, values are not equal")
+                    return False
         return True
 
 
@@ -113,20 +184,27 @@ class DB(metaclass=ABCMeta):  # noqa B024
     """
 
     engine = None
-    sessionmaker = sessionmaker()
+    sessionmaker = None
     sqlalchemy_base = None
 
-    def __init__(self, sqlalchemy_base, db_url):  # noqa
+    def __init__(self, sqlalchemy_base, db_url, pool_settings=None):  # noqa
         self.sqlalchemy_base = Base
-        self.engine = create_engine(db_url)
-        self.sessionmaker.configure(bind=self.engine)
+        pool_kwargs = DEFAULT_POOL_SETTINGS.copy()
+        if pool_settings is not None:
+            pool_kwargs.update(pool_settings)
+        self.engine = _make_engine(db_url, **pool_kwargs)
+        # Each DB object gets its own sessionmaker bound to its own engine.
+        # Don't expire objects on commit so that objects returned from functions
+        # that use their own session can still be used (and don't trigger
+        # extra SELECTs) after the session is committed and closed.
+        self.sessionmaker = sessionmaker(bind=self.engine, expire_on_commit=False)
 
 
 class DeclarativeDB(DB):
     """Declarative database object -- to create database tables."""
 
-    def __init__(self, db_url):
-        super().__init__(Base, db_url)
+    def __init__(self, db_url, pool_settings=None):
+        super().__init__(Base, db_url, pool_settings=pool_settings)
 
     def create_tables(self):
         """Create all tables."""
@@ -147,8 +225,8 @@ class AutomappedDB(DB):
 
     """
 
-    def __init__(self, db_url):
-        super().__init__(automap_base(), db_url)
+    def __init__(self, db_url, pool_settings=None):
+        super().__init__(automap_base(), db_url, pool_settings=pool_settings)
 
         from .db_check import is_valid_database
 
@@ -160,37 +238,43 @@ class AutomappedDB(DB):
                 )
 
 
-def get_heratape_db(
-    config_file: str = config_file,
-    forced_db_name: str | None = None,
-    check_connect: bool = True,
-):
+@functools.lru_cache(maxsize=4)
+def _load_config(config_file, mtime_ns):
+    """Load the config file, reusing the result until the file is modified."""
+    with open(config_file, "rb") as f:
+        if orjson is not None:
+            return orjson.loads(f.read())
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_db(db_mode, db_url, pool_settings):
     """
-    Get a DB object that is connected to the heratape database.
+    Get a DB object, reusing it for repeated calls with the same settings.
 
-    Parameters
-    ----------
-    config_file : str
-        Path to the heratape_config.json configuration file.
-    forced_db_name : str, optional
-        Database name to use (forced). If not set, uses the default one from
-        args.
-    check_connect : bool
-        Option to test the database connection.
+    This avoids repeating the schema check for production databases every
+    time a session is needed. `pool_settings` must be hashable, so it is passed
+    as a tuple of (key, value) pairs (or None).
+    """
+    if pool_settings is not None:
+        pool_settings = dict(pool_settings)
+    if db_mode == "testing":
+        return DeclarativeDB(db_url, pool_settings=pool_settings)
+    return AutomappedDB(db_url, pool_settings=pool_settings)
 
-    Returns
-    -------
-    DB object
-        An instance of the `DB` class providing access to the heratape database.
 
+@functools.lru_cache(maxsize=8)
+def _get_db_from_config(config_file, mtime_ns, forced_db_name):
     """
-    db_name = None
-    if forced_db_name is not None:
-        db_name = forced_db_name
+    Get the DB object for a database in a config file.
 
-    with open(config_file) as f:
-        config_data = json.load(f)
+    The result is cached for each version of the config file (as identified by
+    its modification time), so repeated calls (e.g. for every `HTSessionWrapper`)
+    skip parsing and validating the config.
+    """
+    config_data = _load_config(config_file, mtime_ns)
 
+    db_name = forced_db_name
     if db_name is None:
         db_name = config_data.get("default_db_name")
         if db_name is None:
@@ -227,16 +311,58 @@ def get_heratape_db(
             f"the DB named {db_name!r} in {config_file!r}"
         )
 
-    if db_mode == "testing":
-        db = DeclarativeDB(db_url)
-    elif db_mode == "production":
-        db = AutomappedDB(db_url)
-    else:
+    pool_settings = db_data.get("pool")
+    if pool_settings is not None:
+        unknown_keys = set(pool_settings) - set(DEFAULT_POOL_SETTINGS)
+        if len(unknown_keys) > 0:
+            raise RuntimeError(
+                "cannot connect to heratape database: unrecognized pool settings "
+                f"{sorted(unknown_keys)} for the DB named {db_name!r} in "
+                f"{config_file!r}"
+            )
+
+    if db_mode not in ("testing", "production"):
         raise RuntimeError(
             "cannot connect to heratape database: unrecognized mode "
             f"{db_mode!r} for the DB named {db_name!r} in {config_file!r}"
         )
 
+    if pool_settings is not None:
+        pool_settings = tuple(sorted(pool_settings.items()))
+    return _get_db(db_mode, db_url, pool_settings)
+
+
+def get_heratape_db(
+    config_file: str = config_file,
+    forced_db_name: str | None = None,
+    check_connect: bool = True,
+):
+    """
+    Get a DB object that is connected to the heratape database.
+
+    Parameters
+    ----------
+    config_file : str
+        Path to the heratape_config.json configuration file. Each database
+        entry may have an optional "pool" section to override any of the
+        connection pool settings in `DEFAULT_POOL_SETTINGS`.
+    forced_db_name : str, optional
+        Database name to use (forced). If not set, uses the default one from
+        args.
+    check_connect : bool
+        Option to test the database connection.
+
+    Returns
+    -------
+    DB object
+        An instance of the `DB` class providing access to the heratape database.
+
+    """
+    # key the cache on the modification time so edits to the file are picked up
+    db = _get_db_from_config(
+        config_file, os.stat(config_file).st_mtime_ns, forced_db_name
+    )
+
     if check_connect:
         # Test database connection
         with db.sessionmaker() as session:
@@ -248,7 +374,7 @@ def get_heratape_db(
     return db
 
 
-def get_heratape_testing_db(forced_db_name="testing"):
+def get_heratape_testing_db(forced_db_name="testing", check_connect=True):
     """
     Get a DB object that is connected to the testing heratape database.
 
@@ -256,6 +382,8 @@ def get_heratape_testing_db(forced_db_name="testing"):
     ----------
     forced_db_name : str
         Database name to use.
+    check_connect : bool
+        Option to test the database connection.
 
     Returns
     -------
@@ -264,7 +392,7 @@ def get_heratape_testing_db(forced_db_name="testing"):
         database.
 
     """
-    return get_heratape_db(forced_db_name=forced_db_name)
+    return get_heratape_db(forced_db_name=forced_db_name, check_connect=check_connect)
 
 
 class HTSessionWrapper:
@@ -275,19 +403,37 @@ class HTSessionWrapper:
     ----------
     session : :class:sqlalchemy.orm.Session, optional
         Supplied session, or None. If it's None, one will be started within
-        this wrapper and then closed on exit. If a session is supplied it will
-        not be closed.
+        this wrapper and then committed (or rolled back if there's an error)
+        and closed on exit. If a session is supplied it will not be committed,
+        rolled back or closed, that is left to the code that created it.
     testing : bool
         Flag to have new session be on the testing database.
 
+    Examples
+    --------
+    All of the functions that take a `session` parameter use this wrapper, so
+    several operations can be done in a single transaction (using a single
+    connection) by passing the same session to each of them:
+
+    >>> with HTSessionWrapper(testing=True) as session:  # doctest: +SKIP
+    ...     add_tape(tape_id=tape_id, ..., session=session)
+    ...     update_tape(tape_id=tape_id, size=size, session=session)
+
+    Everything is committed together when the `with` block exits, or nothing
+    is if there's an error.
+
     """
 
     def __init__(self, session: Session | None = None, testing: bool = False):
         if session is None:
+            # The DB objects are cached, so this just reuses the existing engine
+            # and sessionmaker after the first call. Connections are checked
+            # when they are taken from the pool (pool_pre_ping), so skip the
+            # extra connection check.
             if testing:
-                db = get_heratape_testing_db()
+                db = get_heratape_testing_db(check_connect=False)
             else:
-                db = get_heratape_db()
+                db = get_heratape_db(check_connect=False)
             self.session = db.sessionmaker()
             self.close_when_done = True
         else:
@@ -308,8 +454,13 @@ class HTSessionWrapper:
             _ = self.session.close()
 
     def __exit__(self, exception_type, exception_value, traceback):
-        """Exit the session, rollback if there's an error otherwise commit."""
-        if isinstance(self.session, Session):
+        """
+        Exit the session, rollback if there's an error otherwise commit.
+
+        Only sessions created by this wrapper are committed or rolled back, so
+        nesting wrappers around a supplied session only commits once.
+        """
+        if self.close_when_done and isinstance(self.session, Session):
             if exception_type is not None:
                 self.session.rollback()  # exception raised
             else:
@@ -28,6 +28,41 @@ def check_connection(session):
     return result
 
 
+def _get_db_columns(bind):
+    """
+    Get the column names for each table in a database.
+
+    Parameters
+    ----------
+    bind : SQLAlchemy engine or connection
+        Engine or connection to use to reflect the database.
+
+    Returns
+    -------
+    dict
+        Dict keyed by table name with a set of column names for each table.
+
+    """
+    try:  # This tries thrice with 5sec sleeps in between
+        iengine = inspect(bind)
+    except OperationalError:  # pragma: no cover
+        import time
+
+        time.sleep(5)
+        try:
+            iengine = inspect(bind)
+        except OperationalError:
+            time.sleep(5)
+            iengine = inspect(bind)
+
+    # get the columns for all the tables at once rather than one table at a time
+    db_columns = {
+        table: {col["name"] for col in columns}
+        for (_, table), columns in iengine.get_multi_columns().items()
+    }
+    return db_columns
+
+
 def is_valid_database(base, session):
     """
     Check that the current database matches the models declared in model base.
@@ -57,34 +92,17 @@ def is_valid_database(base, session):
         base = Base
 
     engine = session.get_bind()
-    try:  # This tries thrice with 5sec sleeps in between
-        iengine = inspect(engine)
-    except OperationalError:  # pragma: no cover
-        import time
-
-        time.sleep(5)
-        try:
-            iengine = inspect(engine)
-        except OperationalError:
-            time.sleep(5)
-            iengine = inspect(engine)
+    db_columns = _get_db_columns(engine)
 
     errors = False
     err_msg = ""
 
-    tables = iengine.get_table_names()
-
     # Go through all SQLAlchemy models
 
     for table, klass in base.metadata.tables.items():
-        if table in tables:
+        if table in db_columns:
             # Check all columns are found
-            # Looks like [{'default':
-            #               "nextval('validity_check_test_id_seq'::regclass)",
-            #              'autoincrement': True, 'nullable': False,
-            #              'type': INTEGER(), 'name': 'id'}]
-
-            columns = [c["name"] for c in iengine.get_columns(table)]
+            columns = db_columns[table]
             mapper = inspect(klass)
 
             for column in mapper.columns:
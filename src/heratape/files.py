@@ -5,30 +5,91 @@
 from __future__ import annotations
 
 import datetime
+import functools
+import os
+from itertools import repeat
 from math import floor
-from pathlib import Path
+from typing import TYPE_CHECKING
 
-from astropy.time import Time
+import numpy as np
 from sqlalchemy import (
     BigInteger,
     Column,
     DateTime,
     Float,
     ForeignKey,
+    Index,
     String,
     insert,
+    select,
     update,
 )
-from sqlalchemy.orm import Session
-
-from heratape.tapes import get_tape
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, relationship
 
 from .base import Base, HTSessionWrapper
+from .tapes import Tapes
+
+if TYPE_CHECKING:
+    from astropy.time import Time
 
 # define some default tolerances for various units
 DEFAULT_DAY_TOL = {"atol": 1e-3 / (3600.0 * 24.0), "rtol": 0}  # ms
 DEFAULT_GPS_TOL = {"atol": 1e-3, "rtol": 0}  # ms
 
+# column order for the rows built in add_files_to_tape
+_FILE_KEYS = (
+    "filebase",
+    "filepath",
+    "tape_id",
+    "obsid",
+    "jd_start",
+    "jd",
+    "size",
+    "write_date",
+)
+
+# maximum number of rows (or file names for updates) to send to the database in
+# a single statement
+CHUNK_SIZE = 1000
+
+
+@functools.lru_cache(maxsize=256)
+def _time_str_to_datetime(time_str):
+    """
+    Convert a time string to a datetime (in TT, like for Time objects).
+
+    The results are cached because converting through astropy Time is slow and
+    scripts often pass the same date for many calls.
+    """
+    from astropy.time import Time
+
+    return Time(time_str).tt.datetime
+
+
+def _convert_write_date(write_date, allow_none=True):
+    """
+    Convert a write date to a datetime, raising an error for invalid types.
+
+    astropy is only imported if the write date isn't None, a datetime or a string.
+    """
+    if write_date is None and allow_none:
+        return None
+    if isinstance(write_date, datetime.datetime):
+        return write_date
+    if isinstance(write_date, str):
+        return _time_str_to_datetime(write_date)
+
+    from astropy.time import Time
+
+    if isinstance(write_date, Time):
+        return write_date.tt.datetime
+    if allow_none:
+        raise ValueError(
+            "If set, write_date must be a datetime, astropy Time object or string"
+        )
+    raise ValueError("write_date must be a datetime, astropy Time object or string")
+
 
 class Files(Base):
     """
@@ -53,10 +114,15 @@ class Files(Base):
         File size in bytes.
     write_date : DateTime column
         Date and time when the file was written to tape.
+    tape : relationship to the Tapes table
+        The tape this file is written to. This is not loaded by default
+        (accessing it raises an error).
 
     """
 
     __tablename__ = "files"
+    # composite index to speed up per-tape (and per-tape, per-day) lookups
+    __table_args__ = (Index("ix_files_tape_id_jd", "tape_id", "jd"),)
     filebase = Column(String, primary_key=True)
     filepath = Column(String)
     tape_id = Column(String, ForeignKey("tapes.tape_id"), nullable=False)
@@ -66,10 +132,22 @@ class Files(Base):
     size = Column(BigInteger, nullable=False)
     write_date = Column(DateTime)
 
+    tape = relationship("Tapes", back_populates="files", lazy="raise")
+
     # tolerances set to 1ms
     tols = {"jd_start": DEFAULT_DAY_TOL}
 
 
+# insert statements that skip files that are already in the table, keyed by
+# dialect name. Used by add_files_to_tape if skip_existing is True.
+_INSERT_SKIP_EXISTING = {
+    "postgresql": postgresql.insert(Files).on_conflict_do_nothing(
+        index_elements=["filebase"]
+    ),
+    "sqlite": sqlite.insert(Files).on_conflict_do_nothing(index_elements=["filebase"]),
+}
+
+
 def add_files_to_tape(
     *,
     tape_id: str,
@@ -77,7 +155,8 @@ def add_files_to_tape(
     obsid_list: list[int],
     jd_start_list: list[float],
     size_list: list[int],
-    write_date: Time | datetime.datetime | None = None,
+    write_date: Time | datetime.datetime | str | None = None,
+    skip_existing: bool = False,
     session: Session | None = None,
     testing: bool = False,
 ):
@@ -97,75 +176,76 @@ def add_files_to_tape(
         filepath_list.
     size_list : list of int
         List of file sizes in bytes. Must be the same length as filepath_list.
-    write_date : :class:`astropy.time.Time` or datetime, optional
+    write_date : :class:`astropy.time.Time` or datetime or str, optional
         The date and time the files are written. To pass a human typed date use e.g.
-        Time("2025-01-15 12:15:00").
+        "2025-01-15 12:15:00" (any string that can be parsed by astropy Time).
+    skip_existing : bool
+        Option to skip any files that are already in the Files table rather
+        than erroring. Useful for re-processing a partially added tape. Only
+        supported for postgresql and sqlite databases.
     session : :class:sqlalchemy.orm.Session, optional
         Database session to use. If None, will start a new session, then close.
     testing : bool
         Option to do the operation on the testing database rather than the default one.
 
     """
-    tape_record = get_tape(tape_id, session=session, testing=testing)
-    if tape_record is None:
+    write_date = _convert_write_date(write_date)
+
+    list_lengths = {
+        "filepath_list": len(filepath_list),
+        "obsid_list": len(obsid_list),
+        "jd_start_list": len(jd_start_list),
+        "size_list": len(size_list),
+    }
+    if len(set(list_lengths.values())) != 1:
         raise ValueError(
-            f"tape {tape_id} is not yet in the tapes table. Use the add_tape "
-            "function to add it before adding files to it."
+            "filepath_list, obsid_list, jd_start_list and size_list must all be "
+            f"the same length. Lengths are: {list_lengths}"
         )
+    n_files = list_lengths["filepath_list"]
 
-    if isinstance(write_date, Time):
-        write_date = write_date.tt.datetime
-    elif write_date is not None and not isinstance(write_date, datetime.datetime):
-        raise ValueError("If set, write_date must be a datetime or astropy Time object")
-
-    n_files = len(filepath_list)
-    n_obsids = len(obsid_list)
-    if n_obsids != n_files:
-        raise ValueError(
-            f"obsid_list is length {n_obsids}, filepath_list is length {n_files}. "
-            "They must be the same length."
-        )
-    n_jds = len(jd_start_list)
-    if n_jds != n_files:
-        raise ValueError(
-            f"jd_start_list is length {n_jds}, filepath_list is length {n_files}. "
-            "They must be the same length."
-        )
-    n_sizes = len(size_list)
-    if n_sizes != n_files:
-        raise ValueError(
-            f"size_list is length {n_sizes}, filepath_list is length {n_files}. "
-            "They must be the same length."
-        )
-
-    filebase_list = [Path(filepath).name for filepath in filepath_list]
-    jd_int_list = [int(floor(jd)) for jd in jd_start_list]
+    filebase_list = list(map(os.path.basename, filepath_list))
+    jd_int_list = (
+        np.floor(np.asarray(jd_start_list, dtype=np.float64)).astype(np.int64).tolist()
+    )
 
     file_dict_list = [
-        {
-            "filebase": fbase,
-            "filepath": fpath,
-            "tape_id": tape_id,
-            "obsid": obsid,
-            "jd_start": jd_start,
-            "jd": jd_int,
-            "size": size,
-            "write_date": write_date,
-        }
-        for fbase, fpath, obsid, jd_start, jd_int, size in zip(
+        dict(zip(_FILE_KEYS, row, strict=True))
+        for row in zip(
             filebase_list,
             filepath_list,
+            repeat(tape_id, n_files),
             obsid_list,
             jd_start_list,
             jd_int_list,
             size_list,
+            repeat(write_date, n_files),
             strict=True,
         )
     ]
 
     with HTSessionWrapper(session=session, testing=testing) as ht_sess:
-        # This does a bulk insert in sqlalchemy>=2.0
-        ht_sess.execute(insert(Files), file_dict_list)
+        if ht_sess.get(Tapes, tape_id) is None:
+            raise ValueError(
+                f"tape {tape_id} is not yet in the tapes table. Use the add_tape "
+                "function to add it before adding files to it."
+            )
+
+        if skip_existing:
+            dialect_name = ht_sess.get_bind().dialect.name
+            if dialect_name not in _INSERT_SKIP_EXISTING:
+                raise ValueError(
+                    "skip_existing is only supported for postgresql and sqlite "
+                    f"databases, this database is {dialect_name}."
+                )
+            insert_stmt = _INSERT_SKIP_EXISTING[dialect_name]
+        else:
+            insert_stmt = insert(Files)
+
+        # This does a bulk insert in sqlalchemy>=2.0. Send the rows in chunks to
+        # limit memory use and stay under the database's bound parameter limits.
+        for ind in range(0, len(file_dict_list), CHUNK_SIZE):
+            ht_sess.execute(insert_stmt, file_dict_list[ind : ind + CHUNK_SIZE])
 
 
 def get_all_jds(*, session: Session | None = None, testing: bool = False):
@@ -181,14 +261,13 @@ def get_all_jds(*, session: Session | None = None, testing: bool = False):
 
     """
     with HTSessionWrapper(session=session, testing=testing) as ht_sess:
-        jd_tuple_list = ht_sess.query(Files.jd).distinct().all()
-    jd_list = [val[0] for val in jd_tuple_list]
+        jd_list = ht_sess.scalars(select(Files.jd).distinct()).all()
     return jd_list
 
 
 def set_write_date(
     file_list: list[str],
-    write_date: Time | datetime.datetime,
+    write_date: Time | datetime.datetime | str,
     session: Session | None = None,
     testing: bool = False,
 ):
@@ -199,29 +278,48 @@ def set_write_date(
     ----------
     filebase_list : list of str
         List of files (either full paths or file base names) to set the write date for.
-    write_date : :class:`astropy.time.Time` or datetime
+    write_date : :class:`astropy.time.Time` or datetime or str
         The date the files were written. To pass a human typed date use e.g.
-        Time("2025-01-15 12:15:00").
+        "2025-01-15 12:15:00" (any string that can be parsed by astropy Time).
     session : :class:sqlalchemy.orm.Session, optional
         Database session to use. If None, will start a new session, then close.
     testing : bool
         Option to do the operation on the testing database rather than the default one.
 
+    Raises
+    ------
+    ValueError
+        If any of the files are not in the Files table.
+
     """
-    if isinstance(write_date, Time):
-        write_date = write_date.tt.datetime
-    elif not isinstance(write_date, datetime.datetime):
-        raise ValueError("write_date must be a datetime or astropy Time object")
+    write_date = _convert_write_date(write_date, allow_none=False)
 
     # get file base names. a no-op if basenames are already passed in.
-    filebase_list = [Path(filepath).name for filepath in file_list]
+    filebase_list = list(map(os.path.basename, file_list))
 
-    file_dict_list = [
-        {"filebase": fbase, "write_date": write_date} for fbase in filebase_list
-    ]
     with HTSessionWrapper(session=session, testing=testing) as ht_sess:
-        # This does a bulk update in sqlalchemy>=2.0
-        ht_sess.execute(update(Files), file_dict_list)
+        # All the files get the same write date, so use a single UPDATE per chunk
+        # of file names rather than sending a row per file.
+        n_updated = 0
+        for ind in range(0, len(filebase_list), CHUNK_SIZE):
+            stmt = (
+                update(Files)
+                .where(Files.filebase.in_(filebase_list[ind : ind + CHUNK_SIZE]))
+                .values(write_date=write_date)
+            )
+            n_updated += ht_sess.execute(stmt).rowcount
+
+        if n_updated != len(set(filebase_list)):
+            found = set(
+                ht_sess.scalars(
+                    select(Files.filebase).where(Files.filebase.in_(filebase_list))
+                )
+            )
+            missing = sorted(set(filebase_list) - found)
+            raise ValueError(
+                f"Some files are not in the files table: {missing}. Use the "
+                "add_files_to_tape function to add them."
+            )
 
 
 def update_file(
@@ -231,7 +329,7 @@ def update_file(
     obsid: int | None = None,
     jd_start: str | None = None,
     size: int | None = None,
-    write_date: Time | datetime.datetime | None = None,
+    write_date: Time | datetime.datetime | str | None = None,
     session: Session | None = None,
     testing: bool = False,
 ):
@@ -258,48 +356,46 @@ def update_file(
         Start time in JD for the file.
     size : int
         File size in bytes.
-    write_date : :class:`astropy.time.Time` or datetime, optional
+    write_date : :class:`astropy.time.Time` or datetime or str, optional
         The date the file was written. To pass a human typed date use e.g.
-        Time("2025-01-15 12:15:00").
+        "2025-01-15 12:15:00" (any string that can be parsed by astropy Time).
     session : :class:sqlalchemy.orm.Session, optional
         Database session to use. If None, will start a new session, then close.
     testing : bool
         Option to do the operation on the testing database rather than the default one.
 
     """
-    if tape_id is not None:
-        tape_record = get_tape(tape_id, session=session, testing=testing)
-        if tape_record is None:
-            raise ValueError(
-                f"tape {tape_id} is not yet in the tapes table. Use the add_tape "
-                "function to add it before adding files to it."
-            )
-
-    if isinstance(write_date, Time):
-        write_date = write_date.tt.datetime
-    elif write_date is not None and not isinstance(write_date, datetime.datetime):
-        raise ValueError("If set, write_date must be a datetime or astropy Time object")
-
-    filebase = Path(filename).name
-
-    update_vals = {}
+    write_date = _convert_write_date(write_date)
+
+    filebase = os.path.basename(filename)
+
+    update_vals = {
+        key: value
+        for key, value in (
+            ("tape_id", tape_id),
+            ("obsid", obsid),
+            ("jd_start", jd_start),
+            ("size", size),
+            ("write_date", write_date),
+        )
+        if value is not None
+    }
     if filename != filebase:
         update_vals["filepath"] = filename
-    if tape_id is not None:
-        update_vals["tape_id"] = tape_id
-    if obsid is not None:
-        update_vals["obsid"] = obsid
     if jd_start is not None:
-        update_vals["jd_start"] = jd_start
         update_vals["jd"] = int(floor(jd_start))
-    if size is not None:
-        update_vals["size"] = size
-    if write_date is not None:
-        update_vals["write_date"] = write_date
 
     if len(update_vals) == 0:
         return
 
     stmt = update(Files).where(Files.filebase == filebase).values(**update_vals)
     with HTSessionWrapper(session=session, testing=testing) as ht_sess:
+        # check the tape first (in the same session) rather than relying on the
+        # foreign key, so an error doesn't leave a supplied session in a failed
+        # transaction and an unknown tape is reported even if no file matches.
+        if tape_id is not None and ht_sess.get(Tapes, tape_id) is None:
+            raise ValueError(
+                f"tape {tape_id} is not yet in the tapes table. Use the add_tape "
+                "function to add it before adding files to it."
+            )
         ht_sess.execute(stmt)
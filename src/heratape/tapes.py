@@ -5,17 +5,33 @@
 from __future__ import annotations
 
 import datetime
+import numbers
+from collections.abc import Iterator
+from typing import TYPE_CHECKING
 
-from astropy.time import Time
-from sqlalchemy import BigInteger, Column, Date, String, update
-from sqlalchemy.orm import Session
+import numpy as np
+from sqlalchemy import BigInteger, Column, Date, String, insert, select, update
+from sqlalchemy.orm import Session, relationship, selectinload
 
 from .base import Base, HTSessionWrapper
 
+if TYPE_CHECKING:
+    from astropy.time import Time
+
 # define some default tolerances for various units
 DEFAULT_DAY_TOL = {"atol": 1e-3 / (3600.0 * 24.0), "rtol": 0}  # ms
 DEFAULT_GPS_TOL = {"atol": 1e-3, "rtol": 0}  # ms
 
+# minimum tape size in bytes (1TB), as an int to avoid float comparisons
+MIN_TAPE_SIZE = 1_000_000_000_000
+
+# functions to convert purchase dates to dates, keyed by type. astropy Time is
+# handled separately so that astropy is only imported when needed.
+_PURCHASE_DATE_CONVERTERS = {
+    datetime.datetime: datetime.datetime.date,
+    datetime.date: lambda purchase_date: purchase_date,
+}
+
 
 class Tapes(Base):
     """
@@ -31,6 +47,10 @@ class Tapes(Base):
         Tape capacity in bytes.
     purchase_date : DateTime Column
         Purchase date.
+    files : relationship to the Files table
+        The files written to this tape. This is not loaded by default (accessing
+        it raises an error), use the `with_files` option on `get_tape` or
+        `get_tapes` to load it.
 
     """
 
@@ -40,6 +60,57 @@ class Tapes(Base):
     size = Column(BigInteger, nullable=False)
     purchase_date = Column(Date)
 
+    # lazy="raise" so that we never accidentally issue one query per tape.
+    files = relationship("Files", back_populates="tape", lazy="raise")
+
+
+def _convert_purchase_date(purchase_date):
+    """Convert a purchase date to a date, raising an error for invalid types."""
+    # walk the MRO so subclasses (e.g. of datetime) are handled, the common
+    # types are found on the first lookup.
+    for cls in type(purchase_date).__mro__:
+        converter = _PURCHASE_DATE_CONVERTERS.get(cls)
+        if converter is not None:
+            return converter(purchase_date)
+
+    from astropy.time import Time
+
+    if isinstance(purchase_date, Time):
+        return purchase_date.tt.datetime.date()
+    raise ValueError("purchase date must be a datetime or astropy Time object")
+
+
+def _validate_tape_size(size):
+    """Check that a tape size is an int of at least 1TB."""
+    # allow any integer type (e.g. numpy ints) but not bools, which count as ints
+    if not isinstance(size, numbers.Integral) or isinstance(size, (bool, np.bool_)):
+        raise ValueError(
+            f"size must be an int (note the units are bytes). size: {size!r}"
+        )
+    if size < MIN_TAPE_SIZE:
+        raise ValueError(
+            f"size is less than 1TB (note the units are bytes). size: {size}"
+        )
+
+
+def _tape_row(
+    *,
+    tape_id: str,
+    tape_type: str,
+    size: int,
+    purchase_date: Time | datetime.datetime | datetime.date,
+):
+    """Validate the values for a new tape and return them as a row dict."""
+    purchase_date = _convert_purchase_date(purchase_date)
+    _validate_tape_size(size)
+
+    return {
+        "tape_id": tape_id,
+        "tape_type": tape_type,
+        "size": int(size),
+        "purchase_date": purchase_date,
+    }
+
 
 def add_tape(
     *,
@@ -53,6 +124,8 @@ def add_tape(
     """
     Add a new tape to the Tapes table.
 
+    To add many tapes at once, use `add_tapes`.
+
     Parameters
     ----------
     tape_id : str
@@ -71,28 +144,59 @@ def add_tape(
         Option to do the operation on the testing database rather than the default one.
 
     """
-    if isinstance(purchase_date, Time):
-        purchase_date = purchase_date.tt.datetime
-    elif isinstance(purchase_date, datetime.datetime):
-        purchase_date.date()
-    elif not isinstance(purchase_date, datetime.date):
-        raise ValueError("purchase date must be a datetime or astropy Time object")
+    add_tapes(
+        [
+            {
+                "tape_id": tape_id,
+                "tape_type": tape_type,
+                "size": size,
+                "purchase_date": purchase_date,
+            }
+        ],
+        session=session,
+        testing=testing,
+    )
 
-    if size < 1e12:
-        raise ValueError(
-            f"size is less than 1TB (note the units are bytes). size: {size}"
-        )
 
-    tape_obj = Tapes(
-        tape_id=tape_id, tape_type=tape_type, size=size, purchase_date=purchase_date
-    )
+def add_tapes(
+    tape_list: list[dict], *, session: Session | None = None, testing: bool = False
+):
+    """
+    Add several new tapes to the Tapes table with a single bulk insert.
+
+    All the tapes are validated before any are added, so if any of them are
+    invalid none of them will be added. The rows are sent to the database as
+    multi-row INSERT statements of up to `INSERTMANYVALUES_PAGE_SIZE` rows (see
+    `heratape.base`), so large lists need few round trips at the cost of larger
+    statements.
+
+    Parameters
+    ----------
+    tape_list : list of dict
+        List of dicts, one per tape, with keys "tape_id", "tape_type", "size"
+        and "purchase_date". See `add_tape` for a description of the values.
+    session : :class:sqlalchemy.orm.Session, optional
+        Database session to use. If None, will start a new session, then close.
+    testing : bool
+        Option to do the operation on the testing database rather than the default one.
+
+    """
+    row_list = [_tape_row(**tape) for tape in tape_list]
+    if len(row_list) == 0:
+        return
 
     with HTSessionWrapper(session=session, testing=testing) as ht_sess:
-        ht_sess.add(tape_obj)
-        ht_sess.commit()
+        # This does a bulk insert in sqlalchemy>=2.0
+        ht_sess.execute(insert(Tapes), row_list)
 
 
-def get_tape(tape_id: str, *, session: Session | None = None, testing: bool = False):
+def get_tape(
+    tape_id: str,
+    *,
+    with_files: bool = False,
+    session: Session | None = None,
+    testing: bool = False,
+):
     """
     Get a Tape object.
 
@@ -100,18 +204,102 @@ def get_tape(tape_id: str, *, session: Session | None = None, testing: bool = Fa
     ----------
     tape_id : str
         The unique identifier of the tape.
+    with_files : bool
+        Option to also load the files on the tape (in the `files` attribute).
+    session : :class:sqlalchemy.orm.Session, optional
+        Database session to use. If None, will start a new session, then close.
+    testing : bool
+        Option to do the operation on the testing database rather than the default one.
+
+    Returns
+    -------
+    Tapes or None
+        The Tapes object for this tape_id or None if there is no such tape.
+
+    """
+    with HTSessionWrapper(session=session, testing=testing) as ht_sess:
+        if with_files:
+            # populate_existing so the files are loaded even if the tape is
+            # already in the session
+            return ht_sess.get(
+                Tapes,
+                tape_id,
+                options=[selectinload(Tapes.files)],
+                populate_existing=True,
+            )
+        # primary key lookup, uses the session's identity map if possible
+        return ht_sess.get(Tapes, tape_id)
+
+
+def get_tapes(
+    tape_ids: list[str],
+    *,
+    with_files: bool = False,
+    session: Session | None = None,
+    testing: bool = False,
+):
+    """
+    Get a list of Tape objects.
+
+    Parameters
+    ----------
+    tape_ids : list of str
+        The unique identifiers of the tapes.
+    with_files : bool
+        Option to also load the files on the tapes (in the `files` attribute).
+        All the files are loaded with a single extra query.
+    session : :class:sqlalchemy.orm.Session, optional
+        Database session to use. If None, will start a new session, then close.
+    testing : bool
+        Option to do the operation on the testing database rather than the default one.
+
+    Returns
+    -------
+    list of Tapes
+        The Tapes objects for the tape_ids that are in the tapes table, sorted
+        by tape_id.
+
+    """
+    stmt = select(Tapes).where(Tapes.tape_id.in_(tape_ids)).order_by(Tapes.tape_id)
+    if with_files:
+        stmt = stmt.options(selectinload(Tapes.files)).execution_options(
+            populate_existing=True
+        )
+    with HTSessionWrapper(session=session, testing=testing) as ht_sess:
+        return ht_sess.scalars(stmt).all()
+
+
+def iter_tapes(
+    *, batch_size: int = 10_000, session: Session | None = None, testing: bool = False
+) -> Iterator[Tapes]:
+    """
+    Iterate over all the tapes in the Tapes table, sorted by tape_id.
+
+    The tapes are read from the database in batches using a server-side cursor
+    (where supported), so only one batch is held in memory at a time. The
+    session (or the database connection if a session is supplied) is in use
+    until the iterator is exhausted, so either consume it fully or call its
+    `close` method when done.
+
+    Parameters
+    ----------
+    batch_size : int
+        Number of tapes to fetch from the database at a time.
     session : :class:sqlalchemy.orm.Session, optional
         Database session to use. If None, will start a new session, then close.
     testing : bool
         Option to do the operation on the testing database rather than the default one.
 
+    Yields
+    ------
+    Tapes
+        The Tapes objects.
+
     """
+    # yield_per also turns on stream_results for the ORM
+    stmt = select(Tapes).order_by(Tapes.tape_id).execution_options(yield_per=batch_size)
     with HTSessionWrapper(session=session, testing=testing) as ht_sess:
-        record_list = ht_sess.query(Tapes).filter(Tapes.tape_id == tape_id).all()
-    if len(record_list) == 0:
-        return None
-    else:
-        return record_list[0]
+        yield from ht_sess.scalars(stmt)
 
 
 def update_tape(
@@ -126,9 +314,9 @@ def update_tape(
     """
     Update a single tape record.
 
-    The tape_id must be passed and must match an existing entry in the database.
-    The other column values (tape_type, size, purchase_date) should only be
-    passed if you want to update them.
+    The tape_id must be passed and must match an existing entry in the database
+    (otherwise a ValueError is raised). The other column values (tape_type, size,
+    purchase_date) should only be passed if you want to update them.
 
     Parameters
     ----------
@@ -147,29 +335,38 @@ def update_tape(
         Option to do the operation on the testing database rather than the default one.
 
     """
-    if isinstance(purchase_date, Time):
-        purchase_date = purchase_date.tt.datetime
-    elif isinstance(purchase_date, datetime.datetime):
-        purchase_date.date()
-    elif purchase_date is not None and not isinstance(purchase_date, datetime.date):
-        raise ValueError("purchase date must be a datetime or astropy Time object")
+    if purchase_date is not None:
+        purchase_date = _convert_purchase_date(purchase_date)
 
-    if size is not None and size < 1e12:
-        raise ValueError(
-            f"size is less than 1TB (note the units are bytes). size: {size}"
-        )
+    if size is not None:
+        _validate_tape_size(size)
 
     update_vals = {}
     if tape_type is not None:
         update_vals["tape_type"] = tape_type
     if size is not None:
-        update_vals["size"] = size
+        update_vals["size"] = int(size)
     if purchase_date is not None:
         update_vals["purchase_date"] = purchase_date
 
     if len(update_vals) == 0:
         return
 
-    stmt = update(Tapes).where(Tapes.tape_id == tape_id).values(**update_vals)
+    # use RETURNING to find out if the tape exists without another query.
+    # Build this per call: the bind parameters carry their values, which the
+    # default "evaluate" session synchronization needs to update any Tapes
+    # objects already in the session. A cached statement with values only
+    # supplied at execute time breaks that. SQLAlchemy caches the compiled SQL,
+    # so building this per call is cheap.
+    stmt = (
+        update(Tapes)
+        .where(Tapes.tape_id == tape_id)
+        .values(**update_vals)
+        .returning(Tapes.tape_id)
+    )
     with HTSessionWrapper(session=session, testing=testing) as ht_sess:
-        ht_sess.execute(stmt)
+        if ht_sess.execute(stmt).scalar_one_or_none() is None:
+            raise ValueError(
+                f"tape {tape_id} is not in the tapes table. Use the add_tape "
+                "function to add it."
+            )
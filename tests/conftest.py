@@ -3,20 +3,101 @@
 
 """Testing environment setup and teardown for pytest."""
 
+import contextlib
 import datetime
+import os
 import urllib
-import warnings
+from types import MappingProxyType
 
 import pytest
 from astropy.time import Time
 from astropy.utils import iers
+from sqlalchemy import text
 from sqlalchemy.orm import Session
 
-from heratape.base import get_heratape_testing_db
+from heratape import base
+from heratape.base import DeclarativeDB, get_heratape_testing_db
+
+
+@contextlib.contextmanager
+def _worker_db(shared_tmp_path, worker_id):
+    """
+    Make a copy of the testing database for a pytest-xdist worker.
+
+    The tables are created once in a template database (by whichever worker
+    gets there first) and each worker's database is cloned from it with
+    ``CREATE DATABASE ... TEMPLATE``. The database user needs the CREATEDB
+    privilege for this. The worker's database is dropped on exit, and the
+    template is dropped by the last worker using it.
+    """
+    from filelock import FileLock
+
+    testing_db = get_heratape_testing_db()
+    testing_url = testing_db.engine.url
+    template_name = f"{testing_url.database}_template"
+    worker_url = testing_url.set(database=f"{testing_url.database}_{worker_id}")
+
+    # CREATE/DROP DATABASE can't be run in a transaction
+    admin_engine = testing_db.engine.execution_options(isolation_level="AUTOCOMMIT")
+    lock = FileLock(shared_tmp_path / "heratape_template.lock")
+    ready_file = shared_tmp_path / "heratape_template.ready"
+    # number of workers currently using the template, so the last one can drop it
+    users_file = shared_tmp_path / "heratape_template.users"
+
+    def _update_users(change):
+        n_users = int(users_file.read_text()) if users_file.exists() else 0
+        n_users += change
+        users_file.write_text(str(n_users))
+        return n_users
+
+    with lock, admin_engine.connect() as conn:
+        if not ready_file.exists():
+            conn.execute(text(f"DROP DATABASE IF EXISTS {template_name}"))
+            # use the same encoding as the testing database
+            encoding = conn.execute(
+                text(
+                    "SELECT pg_encoding_to_char(encoding) FROM pg_database "
+                    "WHERE datname = current_database()"
+                )
+            ).scalar_one()
+            conn.execute(
+                text(
+                    f"CREATE DATABASE {template_name} TEMPLATE template0 "
+                    f"ENCODING '{encoding}'"
+                )
+            )
+            template_db = DeclarativeDB(
+                testing_url.set(database=template_name).render_as_string(
+                    hide_password=False
+                )
+            )
+            template_db.create_tables()
+            # there can't be any connections to the template when cloning it
+            template_db.engine.dispose()
+            ready_file.touch()
+        # cloning is done while holding the lock because postgres can't clone
+        # a template that's being cloned by another worker.
+        conn.execute(text(f"DROP DATABASE IF EXISTS {worker_url.database}"))
+        conn.execute(
+            text(f"CREATE DATABASE {worker_url.database} TEMPLATE {template_name}")
+        )
+        _update_users(1)
+
+    worker_db = DeclarativeDB(worker_url.render_as_string(hide_password=False))
+    try:
+        yield worker_db
+    finally:
+        worker_db.engine.dispose()
+        with lock, admin_engine.connect() as conn:
+            conn.execute(text(f"DROP DATABASE IF EXISTS {worker_url.database}"))
+            if _update_users(-1) == 0:
+                # a worker that starts later will make the template again
+                conn.execute(text(f"DROP DATABASE IF EXISTS {template_name}"))
+                ready_file.unlink()
 
 
 @pytest.fixture(autouse=True, scope="session")
-def setup_and_teardown_package():
+def setup_and_teardown_package(tmp_path_factory):
     # Do a calculation that requires a current IERS table. This will trigger
     # automatic downloading of the IERS table if needed, including trying the
     # mirror site in python 3 (but won't redownload if a current one exists).
@@ -30,13 +111,27 @@ def setup_and_teardown_package():
     except (urllib.error.URLError, OSError, iers.IERSRangeError):
         iers.conf.auto_max_age = None
 
-    test_db = get_heratape_testing_db()
-    test_db.create_tables()
-
-    yield test_db
+    worker_id = os.environ.get("PYTEST_XDIST_WORKER")
+    if worker_id is None:
+        test_db = get_heratape_testing_db()
+        test_db.create_tables()
+
+        yield test_db
+
+        test_db.drop_tables()
+    else:
+        # Running in parallel with pytest-xdist, give each worker its own
+        # database so the workers don't interfere with each other. The base temp
+        # directory's parent is shared between the workers.
+        with (
+            _worker_db(tmp_path_factory.getbasetemp().parent, worker_id) as test_db,
+            pytest.MonkeyPatch.context() as mp,
+        ):
+            # point everything that uses the testing database at this one
+            mp.setattr(base, "get_heratape_testing_db", lambda *args, **kwargs: test_db)
+            yield test_db
 
     iers.conf.auto_max_age = 30
-    test_db.drop_tables()
 
 
 @pytest.fixture(scope="function")
@@ -45,31 +140,44 @@ def test_engine(setup_and_teardown_package):
     return test_db.engine
 
 
-@pytest.fixture(scope="function")
-def test_session(setup_and_teardown_package):
+@pytest.fixture(scope="session")
+def test_connection(setup_and_teardown_package):
+    # A single connection (and transaction) shared by all the tests, which is
+    # rolled back at the end so nothing is ever committed to the database.
     test_db = setup_and_teardown_package
     with test_db.engine.connect() as test_conn, test_conn.begin() as test_trans:
-        session = Session(bind=test_conn)
-        with session as test_session:
-            yield test_session
-
-        # rollback - everything that happened with the
-        # Session above (including calls to commit())
-        # is rolled back.
-        with warnings.catch_warnings():
-            # If an error was raised, rollback may have already been called. If so, this
-            # will give a warning which we filter out here.
-            warnings.filterwarnings(
-                "ignore", "transaction already deassociated from connection"
-            )
-            test_trans.rollback()
+        yield test_conn
+
+        test_trans.rollback()
 
 
 @pytest.fixture(scope="function")
+def test_session(test_connection):
+    # Each test is isolated in a SAVEPOINT on the shared connection. The session
+    # also uses savepoints for its own transactions, so calls to commit() or
+    # rollback() in the code being tested only release or roll back to those,
+    # and everything is rolled back to the outer savepoint after the test.
+    test_savepoint = test_connection.begin_nested()
+    session = Session(
+        bind=test_connection,
+        expire_on_commit=False,
+        join_transaction_mode="create_savepoint",
+    )
+    with session as test_session:
+        yield test_session
+
+    test_savepoint.rollback()
+
+
+@pytest.fixture(scope="session")
 def tape_dict():
-    return {
-        "tape_id": "HERA_01",
-        "tape_type": "foo",
-        "size": int(8e12),
-        "purchase_date": datetime.date(2025, 1, 15),
-    }
+    # read only because it is shared by all the tests, use dict(tape_dict) to
+    # get a copy that can be modified.
+    return MappingProxyType(
+        {
+            "tape_id": "HERA_01",
+            "tape_type": "foo",
+            "size": int(8e12),
+            "purchase_date": datetime.date(2025, 1, 15),
+        }
+    )
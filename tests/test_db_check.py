@@ -1,17 +1,27 @@
 # Copyright (c) 2025 HERA-Team
 # Licensed under the 2-clause BSD License
-import contextlib
+import functools
 import re
 
-import sqlalchemy
 from sqlalchemy import Column, ForeignKey, Integer, String, text
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.orm import declarative_base, declared_attr, relationship, sessionmaker
+from sqlalchemy.orm import Session, declarative_base, declared_attr, relationship
 
 from heratape.base import DeclarativeDB
 from heratape.db_check import check_connection, is_valid_database
 
+TABLE_MISSING_RE = re.compile(
+    "Model validity_check_test declares table validity_check_test which does not "
+    "exist in database"
+)
+COLUMN_MISSING_RE = re.compile(
+    "Model validity_check_test declares column foo which does not exist in database"
+)
 
+
+# The models are only built once, the tests create and drop their tables as
+# needed so they can be shared.
+@functools.cache
 def gen_test_model():
     base = declarative_base()
 
@@ -27,6 +37,7 @@ def gen_test_model():
     return base, ValidTestModel
 
 
+@functools.cache
 def gen_relation_models():
     base = declarative_base()
 
@@ -46,6 +57,7 @@ def gen_relation_models():
     return base, RelationTestModel, RelationTestModel2
 
 
+@functools.cache
 def gen_declarative():
     base = declarative_base()
 
@@ -69,13 +81,15 @@ def test_validity_pass(test_engine, test_session):
     See database validity check completes when tables and columns are created.
     """
     base, valid_test_model = gen_test_model()
-    with contextlib.suppress(sqlalchemy.exc.NoSuchTableError):
-        base.metadata.drop_all(test_engine, tables=[valid_test_model.__table__])
+    base.metadata.drop_all(test_engine, tables=[valid_test_model.__table__])
 
     base_is_none = is_valid_database(None, test_session)
     assert base_is_none
 
-    base.metadata.create_all(test_engine, tables=[valid_test_model.__table__])
+    # the table was just dropped, so no need to check if it exists
+    base.metadata.create_all(
+        test_engine, tables=[valid_test_model.__table__], checkfirst=False
+    )
 
     try:
         db_valid, _ = is_valid_database(base, test_session)
@@ -87,45 +101,35 @@ def test_validity_pass(test_engine, test_session):
 def test_validity_table_missing(test_engine, test_session):
     """See check fails when there is a missing table"""
     base, valid_test_model = gen_test_model()
-    with contextlib.suppress(sqlalchemy.exc.NoSuchTableError):
-        base.metadata.drop_all(test_engine, tables=[valid_test_model.__table__])
+    base.metadata.drop_all(test_engine, tables=[valid_test_model.__table__])
 
     db_valid, valid_msg = is_valid_database(base, test_session)
     assert not db_valid
-    expected_msg = (
-        "Model validity_check_test declares table validity_check_test which does not "
-        "exist in database"
-    )
-
-    assert re.compile(expected_msg).search(valid_msg)
+    assert TABLE_MISSING_RE.search(valid_msg)
 
 
 def test_validity_column_missing(test_engine):
     """See check fails when there is a missing table"""
-    with test_engine.begin() as conn:
-        sess_obj = sessionmaker(bind=test_engine)
-        with sess_obj() as session:
-            base, valid_test_model = gen_test_model()
-            with contextlib.suppress(sqlalchemy.exc.NoSuchTableError):
-                base.metadata.drop_all(test_engine, tables=[valid_test_model.__table__])
-            base.metadata.create_all(test_engine, tables=[valid_test_model.__table__])
-
-        # Delete one of the columns
-        conn.execute(text("ALTER TABLE validity_check_test DROP COLUMN foo"))
-
-    # use a new context manager to make sure there are no open transactions
-    # without this it hangs
-    with test_engine.begin() as conn:
-        sess_obj = sessionmaker(bind=test_engine)
-        with sess_obj() as session:
-            db_valid, valid_msg = is_valid_database(base, session)
-            assert not db_valid
-            expected_msg = (
-                "Model validity_check_test declares column foo which does not exist in "
-                "database"
+    base, valid_test_model = gen_test_model()
+    # use a single connection for the DDL and the check
+    with test_engine.connect() as conn:
+        with conn.begin():
+            base.metadata.drop_all(conn, tables=[valid_test_model.__table__])
+            base.metadata.create_all(
+                conn, tables=[valid_test_model.__table__], checkfirst=False
             )
 
-        assert re.compile(expected_msg).search(valid_msg)
+            # Delete one of the columns
+            conn.execute(text("ALTER TABLE validity_check_test DROP COLUMN foo"))
+
+        try:
+            with conn.begin(), Session(bind=conn) as session:
+                db_valid, valid_msg = is_valid_database(base, session)
+            assert not db_valid
+            assert COLUMN_MISSING_RE.search(valid_msg)
+        finally:
+            with conn.begin():
+                base.metadata.drop_all(conn)
 
 
 def test_validity_pass_relationship(test_engine, test_session):
@@ -134,16 +138,11 @@ def test_validity_pass_relationship(test_engine, test_session):
     deem them as missing column.
     """
     base, relation_test_model, relation_test_model2 = gen_relation_models()
-    with contextlib.suppress(sqlalchemy.exc.NoSuchTableError):
-        base.metadata.drop_all(
-            test_engine,
-            tables=[relation_test_model.__table__, relation_test_model2.__table__],
-        )
-
-    base.metadata.create_all(
-        test_engine,
-        tables=[relation_test_model.__table__, relation_test_model2.__table__],
-    )
+    tables = [relation_test_model.__table__, relation_test_model2.__table__]
+    # recreate the tables in a single transaction
+    with test_engine.begin() as conn:
+        base.metadata.drop_all(conn, tables=tables)
+        base.metadata.create_all(conn, tables=tables, checkfirst=False)
 
     try:
         db_valid, _ = is_valid_database(base, test_session)
@@ -158,10 +157,11 @@ def test_validity_pass_declarative(test_engine, test_session):
     them as missing column.
     """
     base, declarative_test_model = gen_declarative()
-    with contextlib.suppress(sqlalchemy.exc.NoSuchTableError):
-        base.metadata.drop_all(test_engine, tables=[declarative_test_model.__table__])
-
-    base.metadata.create_all(test_engine, tables=[declarative_test_model.__table__])
+    tables = [declarative_test_model.__table__]
+    # recreate the table in a single transaction
+    with test_engine.begin() as conn:
+        base.metadata.drop_all(conn, tables=tables)
+        base.metadata.create_all(conn, tables=tables, checkfirst=False)
 
     try:
         db_valid, _ = is_valid_database(base, test_session)
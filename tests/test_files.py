@@ -2,65 +2,86 @@
 # Licensed under the 2-clause BSD License
 """Test tapes."""
 
-import copy
 import datetime
+import re
 from math import floor
-from pathlib import Path
+from types import MappingProxyType
 
 import numpy as np
 import pytest
-from astropy.time import Time, TimeDelta
+from astropy.time import Time
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
 
+import heratape.files
 from heratape import Files
 from heratape.files import add_files_to_tape, get_all_jds, set_write_date, update_file
-from heratape.tapes import add_tape
+from heratape.tapes import add_tape, get_tape, get_tapes
 
+# write dates used in the tests, in the different supported forms. Times and
+# strings are stored as TT, so they have a different expected datetime.
+_WD_DT = datetime.datetime(2025, 3, 15, 10, 20, 6)
+_WD_TIME = Time("2025-03-15T10:20:06", scale="utc")
+_WD_STR = "2025-03-15T10:20:06"
+_WD_TT_DT = datetime.datetime(2025, 3, 15, 10, 21, 15, 184000)
 
-@pytest.fixture(scope="function")
+
+@pytest.fixture(scope="session")
 def file_dict(tape_dict):
     n_files = 10
-    time_starts = Time("2021-12-14T00:00:00", scale="utc") + TimeDelta(
-        np.linspace(-3600, 3600, n_files), format="sec"
-    )
-    jd_starts = time_starts.jd
-    obids = [int(floor(tval.gps)) for tval in time_starts]
-    int_jds = [int(floor(jd)) for jd in jd_starts]
+    # offsets in seconds from the base time. Adding these directly to the jd and
+    # gps time is accurate enough for test data and avoids a TimeDelta.
+    base_time = Time("2021-12-14T00:00:00", scale="utc")
+    offsets = np.linspace(-3600, 3600, n_files)
+    jd_starts = base_time.jd + offsets / 86400.0
+    obids = np.floor(base_time.gps + offsets).astype(np.int64).tolist()
+    int_jds = np.floor(jd_starts).astype(np.int64).tolist()
     assert np.all(np.asarray(int_jds) == int_jds[0])
 
-    filepaths = [
-        str(Path(f"/home/data/{int_jds[0]}/zen_{jd}_sum.uvh5")) for jd in jd_starts
-    ]
     filebases = [f"zen_{jd}_sum.uvh5" for jd in jd_starts]
+    filepaths = [f"/home/data/{int_jds[0]}/{fbase}" for fbase in filebases]
     sizes = [int(2e9)] * n_files
 
-    return {
-        "filebases": filebases,
-        "tape_id": tape_dict["tape_id"],
-        "write_date": datetime.datetime(2025, 3, 15, 10, 20, 6),
-        "filepath_list": filepaths,
-        "obsid_list": obids,
-        "jd_start_list": jd_starts,
-        "int_jds": int_jds,
-        "size_list": sizes,
-    }
+    # read only because it is shared by all the tests, use a copy to modify it.
+    return MappingProxyType(
+        {
+            "filebases": filebases,
+            "tape_id": tape_dict["tape_id"],
+            "write_date": _WD_DT,
+            "filepath_list": filepaths,
+            "obsid_list": obids,
+            "jd_start_list": jd_starts,
+            "int_jds": int_jds,
+            "size_list": sizes,
+        }
+    )
+
+
+@pytest.fixture(scope="function")
+def tape_inserted(test_session, tape_dict):
+    # the files tests need the tape to be in the tapes table
+    add_tape(session=test_session, **tape_dict)
 
 
 @pytest.mark.parametrize(
-    "write_date",
-    [
-        datetime.datetime(2025, 3, 15, 10, 20, 6),
-        Time("2025-03-15T10:20:06", scale="utc"),
-    ],
+    ("write_date", "exp_write_date"),
+    [(_WD_DT, _WD_DT), (_WD_TIME, _WD_TT_DT), (_WD_STR, _WD_TT_DT)],
+    ids=["datetime", "Time", "str"],
 )
 @pytest.mark.parametrize(
     ("set_date", "set_full_paths"), [(True, True), (True, False), (False, False)]
 )
+@pytest.mark.usefixtures("tape_inserted")
 def test_add_files_to_tape(
-    test_session, tape_dict, file_dict, write_date, set_date, set_full_paths
+    test_session,
+    tape_dict,
+    file_dict,
+    write_date,
+    exp_write_date,
+    set_date,
+    set_full_paths,
 ):
-    add_tape(session=test_session, **tape_dict)
-
-    file_dict_use = copy.deepcopy(file_dict)
+    file_dict_use = dict(file_dict)
     file_dict_use.pop("filebases")
     file_dict_use.pop("int_jds")
     if set_date:
@@ -71,7 +92,6 @@ def test_add_files_to_tape(
     add_files_to_tape(session=test_session, **file_dict_use)
 
     if set_date:
-        file_records = test_session.query(Files).all()
         test_session.commit()
         if set_full_paths:
             file_list = file_dict["filepath_list"]
@@ -79,41 +99,101 @@ def test_add_files_to_tape(
             file_list = file_dict["filebases"]
         set_write_date(file_list=file_list, write_date=write_date, session=test_session)
 
-    if isinstance(write_date, Time):
-        exp_write_date = write_date.tt.datetime
-    else:
-        exp_write_date = write_date
-    expected_list = [
-        Files(
-            filebase=fbase,
-            filepath=fpath,
-            tape_id=tape_dict["tape_id"],
-            obsid=obsid,
-            jd_start=jd_start,
-            jd=jd_int,
-            size=size,
-            write_date=exp_write_date,
-        )
-        for fbase, fpath, obsid, jd_start, jd_int, size in zip(
+    # columns that are compared exactly, jd_start is compared separately below
+    key_cols = ("filebase", "filepath", "tape_id", "obsid", "jd", "size", "write_date")
+    expected_rows = {
+        (fbase, fpath, tape_dict["tape_id"], obsid, jd_int, size, exp_write_date)
+        for fbase, fpath, obsid, jd_int, size in zip(
             file_dict["filebases"],
             file_dict["filepath_list"],
             file_dict["obsid_list"],
-            file_dict["jd_start_list"],
             file_dict["int_jds"],
             file_dict["size_list"],
             strict=True,
         )
-    ]
+    }
+    expected_jd_starts = dict(
+        zip(file_dict["filebases"], file_dict["jd_start_list"], strict=True)
+    )
+
+    # stream the records
+    file_rows = set()
+    jd_starts = {}
+    for f_rec in test_session.scalars(select(Files)).yield_per(100):
+        file_rows.add(tuple(getattr(f_rec, col) for col in key_cols))
+        jd_starts[f_rec.filebase] = f_rec.jd_start
+    assert file_rows == expected_rows
+    # filebase is the primary key, so this also checks the number of records
+    assert jd_starts == pytest.approx(
+        expected_jd_starts, abs=Files.tols["jd_start"]["atol"], rel=0
+    )
+
+    db_jds = get_all_jds(session=test_session)
+    assert db_jds == [file_dict["int_jds"][0]]
+    # check the distinct count on the server side too
+    assert test_session.query(Files.jd).distinct().count() == 1
+
+
+@pytest.mark.usefixtures("tape_inserted")
+def test_add_files_to_tape_chunked(test_session, file_dict, monkeypatch):
+    monkeypatch.setattr(heratape.files, "CHUNK_SIZE", 3)
+
+    file_dict_use = dict(file_dict)
+    file_dict_use.pop("filebases")
+    file_dict_use.pop("int_jds")
+    file_dict_use["write_date"] = None
+
+    add_files_to_tape(session=test_session, **file_dict_use)
 
     file_records = test_session.query(Files).order_by(Files.filebase).all()
-    assert len(file_records) == len(file_dict["filebases"])
+    assert [rec.filebase for rec in file_records] == file_dict["filebases"]
 
-    for f_ind, f_rec in enumerate(file_records):
-        assert f_rec.isclose(expected_list[f_ind])
+    set_write_date(
+        file_list=file_dict["filepath_list"],
+        write_date=file_dict["write_date"],
+        session=test_session,
+    )
+    file_records = test_session.query(Files).order_by(Files.filebase).all()
+    for rec in file_records:
+        assert rec.write_date == file_dict["write_date"]
 
-    db_jds = get_all_jds(session=test_session)
-    assert len(db_jds) == 1
-    assert db_jds[0] == file_dict["int_jds"][0]
+
+@pytest.mark.usefixtures("tape_inserted")
+def test_add_files_to_tape_skip_existing(test_session, file_dict):
+    file_dict_use = dict(file_dict)
+    file_dict_use.pop("filebases")
+    file_dict_use.pop("int_jds")
+
+    # add the first half of the files
+    half_dict = {
+        key: (val[:5] if key.endswith("_list") else val)
+        for key, val in file_dict_use.items()
+    }
+    add_files_to_tape(session=test_session, **half_dict)
+
+    add_files_to_tape(session=test_session, skip_existing=True, **file_dict_use)
+
+    file_records = test_session.query(Files).order_by(Files.filebase).all()
+    assert [rec.filebase for rec in file_records] == file_dict["filebases"]
+
+    # adding the same files again errors if skip_existing is not set
+    with pytest.raises(IntegrityError):
+        add_files_to_tape(session=test_session, **file_dict_use)
+
+
+@pytest.mark.usefixtures("tape_inserted")
+def test_add_files_to_tape_skip_existing_error(test_session, file_dict, monkeypatch):
+    monkeypatch.setattr(heratape.files, "_INSERT_SKIP_EXISTING", {})
+
+    file_dict_use = dict(file_dict)
+    file_dict_use.pop("filebases")
+    file_dict_use.pop("int_jds")
+
+    with pytest.raises(
+        ValueError,
+        match="skip_existing is only supported for postgresql and sqlite databases",
+    ):
+        add_files_to_tape(session=test_session, skip_existing=True, **file_dict_use)
 
 
 @pytest.mark.parametrize(
@@ -127,38 +207,44 @@ def test_add_files_to_tape(
         ),
         (
             "write_date",
-            "2021-12-14T00:00:00",
-            "If set, write_date must be a datetime or astropy Time object",
+            2459562.5,
+            "If set, write_date must be a datetime, astropy Time object or string",
         ),
         (
             "obsid_list",
             [1323471618, 1323472418],
-            "obsid_list is length 2, filepath_list is length 10. They must be "
-            "the same length.",
+            re.escape(
+                "filepath_list, obsid_list, jd_start_list and size_list must all "
+                "be the same length. Lengths are: {'filepath_list': 10, "
+                "'obsid_list': 2, 'jd_start_list': 10, 'size_list': 10}"
+            ),
         ),
         (
             "jd_start_list",
             [2459562.45833333, 2459562.46759259],
-            "jd_start_list is length 2, filepath_list is length 10. They must be "
-            "the same length.",
+            re.escape(
+                "filepath_list, obsid_list, jd_start_list and size_list must all "
+                "be the same length. Lengths are: {'filepath_list': 10, "
+                "'obsid_list': 10, 'jd_start_list': 2, 'size_list': 10}"
+            ),
         ),
         (
             "size_list",
             [int(2e9)] * 2,
-            "size_list is length 2, filepath_list is length 10. They must be "
-            "the same length.",
+            re.escape(
+                "filepath_list, obsid_list, jd_start_list and size_list must all "
+                "be the same length. Lengths are: {'filepath_list': 10, "
+                "'obsid_list': 10, 'jd_start_list': 10, 'size_list': 2}"
+            ),
         ),
     ],
 )
-def test_add_files_to_tape_errors(
-    test_session, tape_dict, file_dict, param, value, err_msg
-):
-    add_tape(session=test_session, **tape_dict)
-
-    file_dict_use = copy.deepcopy(file_dict)
+@pytest.mark.usefixtures("tape_inserted")
+def test_add_files_to_tape_errors(test_session, file_dict, param, value, err_msg):
+    file_dict_use = dict(file_dict)
     file_dict_use.pop("filebases")
     file_dict_use.pop("int_jds")
-    file_dict_use["write_date"] = datetime.datetime(2025, 3, 15, 10, 20, 6)
+    file_dict_use["write_date"] = _WD_DT
 
     file_dict_use[param] = value
 
@@ -166,37 +252,93 @@ def test_add_files_to_tape_errors(
         add_files_to_tape(session=test_session, **file_dict_use)
 
 
+@pytest.mark.usefixtures("tape_inserted")
+def test_get_tapes_with_files(test_session, tape_dict, file_dict):
+    tape_dict2 = dict(tape_dict)
+    tape_dict2["tape_id"] = "HERA_02"
+    add_tape(session=test_session, **tape_dict2)
+
+    file_dict_use = dict(file_dict)
+    file_dict_use.pop("filebases")
+    file_dict_use.pop("int_jds")
+    add_files_to_tape(session=test_session, **file_dict_use)
+
+    tape_obj = get_tape(tape_dict["tape_id"], session=test_session)
+    with pytest.raises(InvalidRequestError, match="'Tapes.files' is not available"):
+        _ = tape_obj.files
+
+    tape_obj = get_tape(tape_dict["tape_id"], with_files=True, session=test_session)
+    assert sorted(f_obj.filebase for f_obj in tape_obj.files) == file_dict["filebases"]
+
+    tape_list = get_tapes(
+        [tape_dict["tape_id"], "HERA_02", "foo"], with_files=True, session=test_session
+    )
+    assert [t_obj.tape_id for t_obj in tape_list] == [tape_dict["tape_id"], "HERA_02"]
+    assert len(tape_list[0].files) == len(file_dict["filebases"])
+    assert len(tape_list[1].files) == 0
+
+    tape_list = get_tapes([tape_dict["tape_id"]], session=test_session)
+    assert len(tape_list) == 1
+
+
 def test_set_write_date_errors():
     with pytest.raises(
-        ValueError, match="write_date must be a datetime or astropy Time object"
+        ValueError, match="write_date must be a datetime, astropy Time object or string"
+    ):
+        set_write_date(file_list=["foo"], write_date=2459562.5)
+
+
+@pytest.mark.usefixtures("tape_inserted")
+def test_set_write_date_missing_file(test_session, file_dict):
+    file_dict_use = dict(file_dict)
+    file_dict_use.pop("filebases")
+    file_dict_use.pop("int_jds")
+    add_files_to_tape(session=test_session, **file_dict_use)
+
+    # nothing tells the caller the write date wasn't set unless this errors
+    file_list = [file_dict["filebases"][0], "nope.uvh5"]
+    with pytest.raises(
+        ValueError,
+        match=re.escape("Some files are not in the files table: ['nope.uvh5']"),
     ):
-        set_write_date(file_list=["foo"], write_date="2021-12-14T00:00:00")
+        set_write_date(file_list=file_list, write_date=_WD_DT, session=test_session)
 
 
 @pytest.mark.parametrize(
-    "update_dict",
+    ("update_dict", "exp_write_date"),
     [
-        {"filename": "/mnt/data1/2459562/zen_2459562.4583333335_sum.uvh5"},
-        {"tape_id": "HERA_02"},
-        {"obsid": 1323471619},
-        {"jd_start": 2459563.4583333335},
-        {"size": int(5e9)},
-        {"write_date": datetime.datetime(2025, 3, 16, 10, 20, 6)},
-        {"write_date": Time("2025-03-16T10:20:06", scale="utc")},
-        {},
+        ({"filename": "/mnt/data1/2459562/zen_2459562.4583333335_sum.uvh5"}, None),
+        ({"tape_id": "HERA_02"}, None),
+        ({"obsid": 1323471619}, None),
+        ({"jd_start": 2459563.4583333335}, None),
+        ({"size": int(5e9)}, None),
+        (
+            {"write_date": datetime.datetime(2025, 3, 16, 10, 20, 6)},
+            datetime.datetime(2025, 3, 16, 10, 20, 6),
+        ),
+        # Times and strings are stored as TT
+        (
+            {"write_date": Time("2025-03-16T10:20:06", scale="utc")},
+            datetime.datetime(2025, 3, 16, 10, 21, 15, 184000),
+        ),
+        (
+            {"write_date": "2025-03-16T10:20:06"},
+            datetime.datetime(2025, 3, 16, 10, 21, 15, 184000),
+        ),
+        ({}, None),
     ],
 )
-def test_update_file(test_session, tape_dict, file_dict, update_dict):
-    add_tape(session=test_session, **tape_dict)
+@pytest.mark.usefixtures("tape_inserted")
+def test_update_file(test_session, tape_dict, file_dict, update_dict, exp_write_date):
     if "tape_id" in update_dict:
-        new_tape_dict = copy.deepcopy(tape_dict)
+        new_tape_dict = dict(tape_dict)
         new_tape_dict["tape_id"] = update_dict["tape_id"]
         add_tape(session=test_session, **new_tape_dict)
 
-    file_dict_use = copy.deepcopy(file_dict)
+    file_dict_use = dict(file_dict)
     file_dict_use.pop("filebases")
     file_dict_use.pop("int_jds")
-    file_dict_use["write_date"] = datetime.datetime(2025, 3, 15, 10, 20, 6)
+    file_dict_use["write_date"] = _WD_DT
 
     add_files_to_tape(session=test_session, **file_dict_use)
 
@@ -218,29 +360,30 @@ def test_update_file(test_session, tape_dict, file_dict, update_dict):
         elif key == "jd_start":
             exp_dict[key] = value
             exp_dict["jd"] = int(floor(value))
-        else:
+        elif key != "write_date":
             exp_dict[key] = value
+    if exp_write_date is not None:
+        exp_dict["write_date"] = exp_write_date
 
     if "filename" not in update_dict:
         update_dict["filename"] = filebase
     update_file(session=test_session, **update_dict)
 
-    file_records = test_session.query(Files).where(Files.filebase == filebase).all()
-    assert len(file_records) == 1
+    file_rec = test_session.scalars(
+        select(Files).where(Files.filebase == filebase)
+    ).one()
 
-    if isinstance(exp_dict["write_date"], Time):
-        exp_dict["write_date"] = exp_dict["write_date"].tt.datetime
     exp_obj = Files(**exp_dict)
 
-    assert file_records[0].isclose(exp_obj)
+    assert file_rec.isclose(exp_obj)
 
 
 @pytest.mark.parametrize(
     ("update_dict", "err_msg"),
     [
         (
-            {"write_date": "2025-01-15"},
-            "If set, write_date must be a datetime or astropy Time object",
+            {"write_date": 2459562.5},
+            "If set, write_date must be a datetime, astropy Time object or string",
         ),
         (
             {"tape_id": "HERA_02"},
@@ -249,8 +392,23 @@ def test_update_file(test_session, tape_dict, file_dict, update_dict):
         ),
     ],
 )
-def test_update_file_errors(test_session, tape_dict, update_dict, err_msg):
-    add_tape(session=test_session, **tape_dict)
-
+@pytest.mark.usefixtures("tape_inserted")
+def test_update_file_errors(test_session, update_dict, err_msg):
     with pytest.raises(ValueError, match=err_msg):
         update_file(filename="foo", session=test_session, **update_dict)
+
+
+@pytest.mark.usefixtures("tape_inserted")
+def test_update_file_bad_tape_session_usable(test_session, file_dict):
+    file_dict_use = dict(file_dict)
+    file_dict_use.pop("filebases")
+    file_dict_use.pop("int_jds")
+    add_files_to_tape(session=test_session, **file_dict_use)
+
+    filebases = file_dict["filebases"]
+    with pytest.raises(ValueError, match="tape HERA_02 is not yet in the tapes table"):
+        update_file(filename=filebases[0], tape_id="HERA_02", session=test_session)
+
+    # the supplied session can still be used after the error
+    update_file(filename=filebases[1], size=5, session=test_session)
+    assert test_session.get(Files, filebases[1]).size == 5
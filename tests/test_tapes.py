@@ -2,15 +2,22 @@
 # Licensed under the 2-clause BSD License
 """Test tapes."""
 
-import copy
 import datetime
 import re
 
+import numpy as np
 import pytest
 from astropy.time import Time
 
 from heratape import Tapes
-from heratape.tapes import add_tape, get_tape, update_tape
+from heratape.tapes import (
+    _tape_row,
+    add_tape,
+    add_tapes,
+    get_tape,
+    iter_tapes,
+    update_tape,
+)
 
 
 @pytest.mark.parametrize(
@@ -18,9 +25,12 @@ from heratape.tapes import add_tape, get_tape, update_tape
     [Time("2025-01-15"), datetime.datetime(2025, 1, 15), datetime.date(2025, 1, 15)],
 )
 def test_add_tape(test_session, tape_dict, purchase_date):
-    dict_use = copy.deepcopy(tape_dict)
+    dict_use = dict(tape_dict)
     dict_use["purchase_date"] = purchase_date
 
+    # the purchase date should always be converted to a date
+    assert type(_tape_row(**dict_use)["purchase_date"]) is datetime.date
+
     add_tape(session=test_session, **dict_use)
 
     tape_records = test_session.query(Tapes).all()
@@ -36,6 +46,60 @@ def test_add_tape(test_session, tape_dict, purchase_date):
     assert tape_obj is None
 
 
+def test_add_tape_numpy_size(test_session, tape_dict):
+    dict_use = {**tape_dict, "size": np.int64(tape_dict["size"])}
+
+    # numpy ints are allowed and converted to python ints
+    assert type(_tape_row(**dict_use)["size"]) is int
+
+    add_tape(session=test_session, **dict_use)
+
+    tape_obj = get_tape(tape_dict["tape_id"], session=test_session)
+    assert tape_obj.isclose(Tapes(**tape_dict))
+
+
+def test_add_tapes(test_session, tape_dict):
+    tape_list = []
+    for tape_ind in range(3):
+        this_dict = dict(tape_dict)
+        this_dict["tape_id"] = f"HERA_{tape_ind:02d}"
+        tape_list.append(this_dict)
+
+    # nothing is added if any tapes are invalid
+    bad_list = [dict(tape) for tape in tape_list]
+    bad_list[-1]["size"] = int(1e6)
+    with pytest.raises(ValueError, match="size is less than 1TB"):
+        add_tapes(bad_list, session=test_session)
+    assert test_session.query(Tapes).count() == 0
+
+    add_tapes([], session=test_session)
+    assert test_session.query(Tapes).count() == 0
+
+    add_tapes(tape_list, session=test_session)
+
+    tape_records = test_session.query(Tapes).order_by(Tapes.tape_id).all()
+    assert len(tape_records) == len(tape_list)
+    for rec, this_dict in zip(tape_records, tape_list, strict=True):
+        assert rec.isclose(Tapes(**this_dict))
+
+
+def test_iter_tapes(test_session, tape_dict):
+    assert list(iter_tapes(session=test_session)) == []
+
+    tape_list = []
+    for tape_ind in [3, 1, 4, 0, 2]:
+        this_dict = dict(tape_dict)
+        this_dict["tape_id"] = f"HERA_{tape_ind:02d}"
+        tape_list.append(this_dict)
+    add_tapes(tape_list, session=test_session)
+
+    # use a batch size that doesn't divide the number of tapes
+    tape_records = list(iter_tapes(batch_size=2, session=test_session))
+    assert [rec.tape_id for rec in tape_records] == [
+        f"HERA_{tape_ind:02d}" for tape_ind in range(5)
+    ]
+
+
 @pytest.mark.parametrize(
     ("param", "value", "err_msg"),
     [
@@ -51,10 +115,23 @@ def test_add_tape(test_session, tape_dict, purchase_date):
                 "size is less than 1TB (note the units are bytes). size: 1000000"
             ),
         ),
+        (
+            "size",
+            8e12,
+            re.escape(
+                "size must be an int (note the units are bytes). size: 8000000000000.0"
+            ),
+        ),
+        (
+            "size",
+            True,
+            re.escape("size must be an int (note the units are bytes). size: True"),
+        ),
+        ("size", np.bool_(True), "size must be an int"),
     ],
 )
 def test_add_tape_errors(test_session, tape_dict, param, value, err_msg):
-    tape_dict[param] = value
+    tape_dict = {**tape_dict, param: value}
 
     with pytest.raises(ValueError, match=err_msg):
         add_tape(session=test_session, **tape_dict)
@@ -65,6 +142,7 @@ def test_add_tape_errors(test_session, tape_dict, param, value, err_msg):
     [
         {"tape_type": "foo"},
         {"size": int(5e12)},
+        {"size": np.int64(5e12)},
         {"purchase_date": Time("2025-02-15")},
         {"purchase_date": datetime.datetime(2025, 2, 15)},
         {"purchase_date": datetime.date(2025, 2, 15)},
@@ -76,10 +154,12 @@ def test_update_tapes(test_session, tape_dict, update_dict):
 
     update_tape(tape_id=tape_dict["tape_id"], session=test_session, **update_dict)
 
-    exp_dict = copy.deepcopy(tape_dict)
+    exp_dict = dict(tape_dict)
 
     for key, value in update_dict.items():
         exp_dict[key] = value
+    # sizes are stored as python ints
+    exp_dict["size"] = int(exp_dict["size"])
     if isinstance(exp_dict["purchase_date"], Time):
         exp_dict["purchase_date"] = exp_dict["purchase_date"].tt.datetime.date()
     elif isinstance(exp_dict["purchase_date"], datetime.datetime):
@@ -92,6 +172,22 @@ def test_update_tapes(test_session, tape_dict, update_dict):
     assert tape_records[0].isclose(test_obj)
 
 
+def test_update_tape_loaded(test_session, tape_dict):
+    # objects already loaded in the session are updated as well
+    add_tape(session=test_session, **tape_dict)
+    tape_obj = get_tape(tape_dict["tape_id"], session=test_session)
+
+    update_tape(
+        tape_dict["tape_id"], size=int(5e12), tape_type="bar", session=test_session
+    )
+    assert tape_obj.size == int(5e12)
+    assert tape_obj.tape_type == "bar"
+
+    tape_obj2 = get_tape(tape_dict["tape_id"], session=test_session)
+    assert tape_obj2 is tape_obj
+    assert tape_obj2.size == int(5e12)
+
+
 @pytest.mark.parametrize(
     ("update_dict", "err_msg"),
     [
@@ -105,10 +201,22 @@ def test_update_tapes(test_session, tape_dict, update_dict):
                 "size is less than 1TB (note the units are bytes). size: 1000000"
             ),
         ),
+        (
+            {"size": 5e12},
+            re.escape(
+                "size must be an int (note the units are bytes). size: 5000000000000.0"
+            ),
+        ),
+        (
+            {"tape_id": "foo", "size": int(5e12)},
+            "tape foo is not in the tapes table. Use the add_tape function to add it.",
+        ),
     ],
 )
 def test_update_tape_errors(test_session, tape_dict, update_dict, err_msg):
     add_tape(session=test_session, **tape_dict)
 
     with pytest.raises(ValueError, match=err_msg):
-        update_tape(tape_id=tape_dict["tape_id"], session=test_session, **update_dict)
+        update_tape(
+            session=test_session, **{"tape_id": tape_dict["tape_id"], **update_dict}
+        )